@@ -1,22 +1,24 @@
 import asyncio
-from mastodon import Mastodon
+from mastodon import Mastodon, MastodonAPIError, MastodonServerError, MastodonUnauthorizedError
 from typing import List, Dict, Optional
-import nltk
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import os
+import sys
 from dotenv import load_dotenv
 import re
+import html
 import time
 from datetime import datetime, timedelta
-import requests
 from io import BytesIO
 from PIL import Image
-import json
+import orjson
+import sqlite3
+from collections import OrderedDict
+from enum import Enum
 import random
 import logging
-from aiohttp import web
+import aiohttp
 
 # Setup logging
 logging.basicConfig(
@@ -27,12 +29,48 @@ logging.basicConfig(
         logging.StreamHandler()
     ]
 )
+logger = logging.getLogger(__name__)
 
-# Download required NLTK data
-nltk.download('punkt')
-nltk.download('stopwords')
+# Gemini errors worth retrying with backoff; anything else fails fast
+_RETRYABLE_GEMINI_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError
+)
+# Quota errors need to outlast Gemini's per-minute window, transient ones don't
+_QUOTA_RETRY_DELAY = 20
+
+# Text cleaning patterns, compiled once and shared by every response path
+_HTML_TAG_RE = re.compile(r"<[^>]+>")
+_WS_RE = re.compile(r"\s+")
+
+class TokenBucket:
+    """Token-bucket rate limiter that allows bursts up to max_per_minute"""
+    __slots__ = ('max_per_minute', 'tokens', 'updated_at')
+
+    def __init__(self, max_per_minute: int):
+        self.max_per_minute = max_per_minute
+        self.tokens = max_per_minute
+        self.updated_at = time.monotonic()
 
-class PostStyle:
+    def _refill(self):
+        now = time.monotonic()
+        new_tokens = (now - self.updated_at) * (self.max_per_minute / 60)
+        self.tokens = min(self.tokens + new_tokens, self.max_per_minute)
+        self.updated_at = now
+
+    async def acquire(self):
+        """Take one token, sleeping only while the bucket is empty"""
+        self._refill()
+        if self.tokens < 1:
+            logger.debug("Rate limit reached, waiting for tokens")
+        while self.tokens < 1:
+            await asyncio.sleep(0.1)
+            self._refill()
+        self.tokens -= 1
+
+class PostStyle(str, Enum):
     MEME = "meme"
     ENTERTAINER = "entertainer"
     INFORMATIVE = "informative"
@@ -40,11 +78,38 @@ class PostStyle:
     ANALYST = "analyst"
 
 class MastodonBot:
-    def __init__(self):
-        # Load environment variables
-        load_dotenv()
+    __slots__ = (
+        'credentials', 'client', '_http', 'max_image_size', 'image_resize_threshold',
+        'model', '_gen_config_multimodal', '_gen_config_text',
+        'max_gemini_requests_per_minute', 'gemini_limiter',
+        'max_requests_per_minute', 'rate_limiter', 'retry_delay',
+        'auto_post_interval', 'post_count', 'max_daily_posts', 'current_style',
+        'dm_context', 'dm_context_file', 'replied_dms', 'replied_dms_db', 'flush_interval',
+        '_dm_dirty', '_dm_since_id',
+        'response_cache', 'response_cache_size', 'response_cache_file', 'cache_hits',
+        '_response_cache_dirty', '_inflight',
+        'post_config', 'hashtags_to_monitor', 'is_running', '_stop_event',
+        'max_concurrent_hashtag_requests', '_hashtag_sem', '_hashtag_since_ids',
+        '_replied_posts', 'replied_posts_size', 'max_replies_per_minute', 'reply_limiter',
+        'min_like_engagement', 'max_likes_per_run', '_like_since_id',
+        'dm_settings'
+    )
+
+    # Static response rules, sent once as the model's system instruction
+    PROMPT_RULES = """
+        Rules:
+        - Maximum 2 sentences
+        - Include 1-2 emojis
+        - Be witty and friendly
+        - Match the post's tone
+        - Add a relevant pop culture reference if it fits naturally
+        - Reference image content naturally (if images present)
         
-        # Initialize credentials
+        Format: Just the response text with emojis.
+        """
+
+    def __init__(self):
+        # Initialize credentials (environment is loaded by the entry point)
         self.credentials = {
             'instance_url': os.getenv('MASTODON_INSTANCE_URL'),
             'client_id': os.getenv('MASTODON_CLIENT_ID'),
@@ -61,28 +126,50 @@ class MastodonBot:
             api_base_url=self.credentials['instance_url']
         )
         
+        # Shared HTTP session for media downloads, created lazily
+        self._http = None
+        self.max_image_size = 1024
+        self.image_resize_threshold = 200 * 1024  # 200KB
+        
         # Initialize Gemini
         genai.configure(api_key=self.credentials['gemini_api_key'])
-        self.model = genai.GenerativeModel('gemini-1.5-pro')
+        self.model = genai.GenerativeModel('gemini-1.5-pro', system_instruction=self.PROMPT_RULES)
+        self._gen_config_multimodal = genai.types.GenerationConfig(temperature=0.7, top_p=0.8, top_k=40)
+        self._gen_config_text = genai.types.GenerationConfig(temperature=0.7, top_p=0.8, top_k=40)
+        self.max_gemini_requests_per_minute = 15
+        self.gemini_limiter = TokenBucket(self.max_gemini_requests_per_minute)
         
         # Rate limiting settings
-        self.last_request_time = 0
-        self.request_count = 0
         self.max_requests_per_minute = 30
+        self.rate_limiter = TokenBucket(self.max_requests_per_minute)
         self.retry_delay = 5
         
         # Auto-posting settings
         self.auto_post_interval = 1800  # 30 minutes
-        self.last_post_time = time.time()
         self.post_count = 0
         self.max_daily_posts = 48  # 2 posts per hour
         self.current_style = PostStyle.ENTERTAINER
         
         # DM handling
-        self.replied_dms = set()
+        self.dm_context = {}
         self.dm_context_file = "dm_context.json"
+        self.replied_dms_db = "dm_context.db"
+        self._dm_dirty = False
+        self._dm_since_id = None
         self._load_dm_context()
         
+        # Response cache for text-only generations of cross-post boilerplate
+        self.response_cache = OrderedDict()
+        self.response_cache_size = 1024
+        self.response_cache_file = "response_cache.json"
+        self.cache_hits = 0
+        self._response_cache_dirty = False
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._load_response_cache()
+        
+        # Pending DM context and response cache changes are written out this often
+        self.flush_interval = 30
+        
         # Configuration
         self.post_config = {
             "use_hashtags": True,
@@ -93,204 +180,587 @@ class MastodonBot:
         # Monitoring settings
         self.hashtags_to_monitor = ["tech", "AI", "programming"]  # Customize these
         self.is_running = False 
-
-    async def _handle_rate_limit(self):
-        """Handle API rate limiting"""
-        current_time = time.time()
-        time_diff = current_time - self.last_request_time
+        self._stop_event = None
+        self.max_concurrent_hashtag_requests = 3
+        self._hashtag_sem = None
+        self._hashtag_since_ids = {}
         
-        # Reset counter after a minute
-        if time_diff >= 60:
-            self.request_count = 0
-            self.last_request_time = current_time
+        # Hashtag reply pacing; ids are remembered so a post tagged twice only gets one reply
+        self._replied_posts = OrderedDict()
+        self.replied_posts_size = 1024
+        self.max_replies_per_minute = 2
+        self.reply_limiter = TokenBucket(self.max_replies_per_minute)
         
-        # If we're at the limit, wait
-        if self.request_count >= self.max_requests_per_minute:
-            wait_time = 60 - time_diff
-            if wait_time > 0:
-                print(f"Rate limit reached, waiting {wait_time:.1f} seconds...")
-                await asyncio.sleep(wait_time)
-                self.request_count = 0
-                self.last_request_time = time.time()
+        # Auto-like settings
+        self.min_like_engagement = 5
+        self.max_likes_per_run = 3
+        self._like_since_id = None
         
-        # Add small delay between requests
-        await asyncio.sleep(2)  # Add 2-second delay between requests
-        self.request_count += 1
+        # DM settings
+        self.dm_settings = {
+            "enabled": True,
+            "auto_reply": True,
+            "reply_interval": 300  # 5 minutes
+        }
+
+    @staticmethod
+    def _clean_html(text: str) -> str:
+        """Strip HTML tags and decode entities in post content"""
+        return _WS_RE.sub(" ", html.unescape(_HTML_TAG_RE.sub(" ", text))).strip()
+
+    @staticmethod
+    def _get_media_attachments(status: Dict) -> List[Dict]:
+        """Extract image attachments from a status"""
+        return [
+            {'url': media['url'], 'description': media.get('description') or ''}
+            for media in status.get('media_attachments', [])
+            if media.get('type') == 'image'
+        ]
+
+    def _get_http(self) -> aiohttp.ClientSession:
+        """Return the shared HTTP session, creating it inside the running loop"""
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        return self._http
+
+    async def _download_image(self, url: str) -> Optional[Image.Image]:
+        """Download an image attachment"""
+        async with self._get_http().get(url) as response:
+            response.raise_for_status()
+            data = await response.read()
+        # Decoding and resizing is CPU-bound, so keep it off the event loop
+        return await asyncio.to_thread(self._prepare_image, data)
 
-    async def generate_entertainment_response(self, post_text: str, status: Dict = None, max_retries=3) -> str:
+    def _prepare_image(self, data: bytes) -> Image.Image:
+        """Decode image bytes, shrinking large images to cut upload size and vision tokens"""
+        image = Image.open(BytesIO(data))
+        
+        # Small images are sent as-is
+        if len(data) < self.image_resize_threshold:
+            return image
+        if image.format == "JPEG":
+            # Let libjpeg decode at a reduced scale before the final resize
+            image.draft("RGB", (self.max_image_size, self.max_image_size))
+        image.thumbnail((self.max_image_size, self.max_image_size), Image.LANCZOS)
+        buf = BytesIO()
+        image.convert("RGB").save(buf, "JPEG", quality=80, optimize=True)
+        buf.seek(0)
+        return Image.open(buf)
+
+    async def shutdown(self):
+        """Flush pending state and release network and database resources"""
+        self._flush_dm_context()
+        self._flush_response_cache()
+        if self.replied_dms is not None:
+            self.replied_dms.close()
+            self.replied_dms = None
+        if self._http is not None and not self._http.closed:
+            await self._http.close()
+        self._http = None
+
+    async def _mapi(self, fn, *args, **kwargs):
+        """Run a blocking Mastodon client call in a worker thread"""
+        return await asyncio.to_thread(fn, *args, **kwargs)
+
+    async def search_hashtag(self, hashtag: str, limit: int = 20, since_id=None) -> List[Dict]:
+        """Fetch recent posts for a hashtag"""
+        return await self._mapi(self.client.timeline_hashtag, hashtag, limit=limit, since_id=since_id)
+
+    async def reply_to_post(self, post_id, text: str):
+        """Reply publicly to a post"""
+        await self._handle_rate_limit()
+        return await self._mapi(self.client.status_post, text, in_reply_to_id=post_id)
+
+    async def _handle_rate_limit(self):
+        """Handle API rate limiting"""
+        await self.rate_limiter.acquire()
+
+    async def generate_entertainment_response(self, post_text: str, status: Dict = None, max_retries=3,
+                                              use_cache: bool = True, history: List[Dict] = None) -> str:
         """Generate a short, fun response using Gemini, including image analysis if present"""
         clean_text = self._clean_html(post_text)
         
-        # Get media attachments if status is provided
+        # Get media attachments if status is provided, downloading them concurrently
         images = []
         if status:
             media_attachments = self._get_media_attachments(status)
-            for media in media_attachments:
-                if image := await self._download_image(media['url']):
+            tasks = [self._download_image(media['url']) for media in media_attachments]
+            downloaded = await asyncio.gather(*tasks, return_exceptions=True)
+            for media, image in zip(media_attachments, downloaded):
+                if isinstance(image, Exception):
+                    logger.error("Error downloading image %s: %s", media['url'], image)
+                elif image:
                     images.append({
                         'image': image,
                         'description': media['description']
                     })
 
+        if images:
+            return await self._generate_multimodal(clean_text, images, max_retries, history)
+        if not use_cache or history:
+            text = await self._generate_content(
+                self._build_prompt(clean_text, False, history), max_retries, generation_config=self._gen_config_text
+            )
+            return text if text is not None else "✨ Interesting perspective! Thanks for sharing! 🌟"
+        return await self._generate_text_only(clean_text, self.current_style, max_retries)
+
+    def _build_prompt(self, clean_text: str, has_images: bool, history: List[Dict] = None) -> str:
+        """Build the response prompt for a cleaned post, with earlier DM exchanges if given"""
         # Modify prompt based on presence of images
         base_prompt = f"""Create a fun, short response to this post: "{clean_text}" """
         
-        if images:
+        if history:
+            earlier = "\n".join(
+                f'- They wrote: "{entry["message"]}" You replied: "{entry["response"]}"' for entry in history
+            )
+            base_prompt = f"Earlier messages in this conversation:\n{earlier}\n\n" + base_prompt
+        
+        if has_images:
             base_prompt += "\nThe post includes images which I'll analyze for context."
             base_prompt += "\nIncorporate relevant details from the images in the response."
         
-        prompt = base_prompt + """
-        Rules:
-        - Maximum 2 sentences
-        - Include 1-2 emojis
-        - Be witty and friendly
-        - Match the post's tone
-        - Add a relevant pop culture reference if it fits naturally
-        - Reference image content naturally (if images present)
+        return base_prompt
+
+    async def _generate_text_only(self, clean_text: str, style: PostStyle, max_retries=3) -> str:
+        """Generate a text-only response, served from the LRU cache when possible"""
+        # The cache is only meant for boilerplate shared by different posts (templated or
+        # spammed text). It relies on monitor_hashtag never replying to the same post twice;
+        # otherwise hits would just be word-for-word duplicate replies.
+        key = f"{style.value}:{clean_text}"
+        if key in self.response_cache:
+            self.response_cache.move_to_end(key)
+            self.cache_hits += 1
+            logger.info("Response cache hit (%d total)", self.cache_hits)
+            return self.response_cache[key]
         
-        Format: Just the response text with emojis.
-        """
+        # Concurrent identical requests share a single Gemini call
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            text = await asyncio.shield(inflight)
+        else:
+            text = await self._generate_coalesced(key, clean_text, max_retries)
+        
+        if text is None:
+            return "✨ Interesting perspective! Thanks for sharing! 🌟"
+        return text
+
+    async def _generate_coalesced(self, key: str, clean_text: str, max_retries=3) -> Optional[str]:
+        """Call Gemini for a text-only prompt, publishing the result to waiting duplicates"""
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        text = None
+        try:
+            text = await self._generate_content(
+                self._build_prompt(clean_text, False), max_retries, generation_config=self._gen_config_text
+            )
+            if text is not None:
+                self.response_cache[key] = text
+                if len(self.response_cache) > self.response_cache_size:
+                    self.response_cache.popitem(last=False)
+                self._response_cache_dirty = True
+        finally:
+            del self._inflight[key]
+            future.set_result(text)
+        return text
+
+    async def _generate_multimodal(self, clean_text: str, images: List[Dict], max_retries=3,
+                                   history: List[Dict] = None) -> str:
+        """Generate a response for a post with images (not cached, images vary)"""
+        # Create a list of content parts for multimodal input
+        content_parts = [self._build_prompt(clean_text, True, history)]
+        for img_data in images:
+            content_parts.append(img_data['image'])
+            if img_data['description']:
+                content_parts.append(f"Image description: {img_data['description']}")
+        
+        text = await self._generate_content(
+            content_parts, max_retries, generation_config=self._gen_config_multimodal
+        )
+        if text is None:
+            return "✨ Interesting perspective! Thanks for sharing! 🌟"
+        return text
+
+    async def _generate_content(self, content, max_retries=3, **kwargs) -> Optional[str]:
+        """Call Gemini with retries, returning None if every attempt fails"""
         for attempt in range(max_retries):
             try:
-                await asyncio.sleep(5)  # Wait 5 seconds between attempts
-                
-                if images:
-                    # Use multimodal generation if images are present
-                    generation_config = {
-                        'temperature': 0.7,
-                        'top_p': 0.8,
-                        'top_k': 40
-                    }
-                    
-                    # Create a list of content parts for multimodal input
-                    content_parts = [prompt]
-                    for img_data in images:
-                        content_parts.append(img_data['image'])
-                        if img_data['description']:
-                            content_parts.append(f"Image description: {img_data['description']}")
-                    
-                    response = self.model.generate_content(
-                        content_parts,
-                        generation_config=generation_config
-                    )
-                else:
-                    # Text-only generation
-                    response = self.model.generate_content(prompt)
-                
+                await self.gemini_limiter.acquire()
+                response = await self.model.generate_content_async(content, **kwargs)
+                usage = response.usage_metadata
+                logger.debug(
+                    "Gemini usage: prompt=%d cached=%d output=%d",
+                    usage.prompt_token_count,
+                    getattr(usage, 'cached_content_token_count', 0),
+                    usage.candidates_token_count
+                )
                 return response.text[:240].strip()  # Maintain character limit
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    wait_time = 10 * (attempt + 1)
-                    print(f"Retry {attempt + 1}/{max_retries} after {wait_time}s...")
-                    await asyncio.sleep(wait_time)
+            except _RETRYABLE_GEMINI_ERRORS as e:
+                if attempt == max_retries - 1:
+                    logger.error("Error generating response: %s", e)
+                    break
+                if isinstance(e, google_exceptions.ResourceExhausted):
+                    wait_time = min(60, _QUOTA_RETRY_DELAY * 2 ** attempt)
                 else:
-                    print(f"Error generating response: {str(e)}")
-                    return "✨ Interesting perspective! Thanks for sharing! 🌟"
-    async def schedule_auto_posts(self):
-        """Main loop for scheduled auto-posting and DM handling"""
-        print("Starting scheduled auto-posting service...")
-        first_run = True
+                    wait_time = min(60, 2 ** attempt)
+                logger.warning("Retry %d/%d after %ds", attempt + 1, max_retries, wait_time)
+                await asyncio.sleep(wait_time)
+            except Exception:
+                logger.exception("Error generating response")
+                break
+        return None
+
+    def _load_response_cache(self):
+        """Load cached text responses from disk"""
+        try:
+            with open(self.response_cache_file, 'rb') as f:
+                self.response_cache.update(orjson.loads(f.read()))
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.exception("Error loading response cache")
+
+    def _flush_response_cache(self):
+        """Write cached text responses to disk if they changed"""
+        if not self._response_cache_dirty:
+            return
+        try:
+            with open(self.response_cache_file, 'wb') as f:
+                f.write(orjson.dumps(self.response_cache))
+            self._response_cache_dirty = False
+        except Exception:
+            logger.exception("Error saving response cache")
+
+    def _load_dm_context(self):
+        """Load DM conversation history and replied DM ids from disk"""
+        try:
+            with open(self.dm_context_file, 'rb') as f:
+                data = orjson.loads(f.read())
+            self.dm_context = data.get('conversations', {})
+            self._dm_since_id = data.get('since_id')
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.exception("Error loading DM context")
+        
+        self._connect_replied_dms()
+
+    def _connect_replied_dms(self):
+        """Open the replied DM store"""
+        # Replied DM ids live in SQLite so history never has to be loaded into memory
+        self.replied_dms = sqlite3.connect(self.replied_dms_db)
+        self.replied_dms.execute("PRAGMA journal_mode=WAL")
+        self.replied_dms.execute("CREATE TABLE IF NOT EXISTS replied (id TEXT PRIMARY KEY)")
+        self.replied_dms.commit()
+
+    def _flush_dm_context(self):
+        """Write DM conversation history to disk if it changed"""
+        if not self._dm_dirty:
+            return
+        try:
+            with open(self.dm_context_file, 'wb') as f:
+                data = {'since_id': self._dm_since_id, 'conversations': self.dm_context}
+                f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+            self._dm_dirty = False
+        except Exception:
+            logger.exception("Error saving DM context")
+
+    def _has_replied_dm(self, dm_id: str) -> bool:
+        """Check whether a DM has already been replied to"""
+        return self.replied_dms.execute(
+            "SELECT 1 FROM replied WHERE id=?", (dm_id,)
+        ).fetchone() is not None
+
+    def _mark_dm_replied(self, dm_id: str):
+        """Record a replied DM"""
+        self.replied_dms.execute("INSERT OR IGNORE INTO replied (id) VALUES (?)", (dm_id,))
+        self.replied_dms.commit()
+
+    async def handle_direct_messages(self):
+        """Reply to new direct messages"""
+        # min_id returns the page right after the cursor, so page forward until caught up
         while True:
+            await self._handle_rate_limit()
+            notifications = await self._mapi(
+                self.client.notifications, min_id=self._dm_since_id, types=['mention']
+            )
+            if not notifications:
+                break
+            await self._reply_to_dm_page(notifications)
+
+    async def _reply_to_dm_page(self, notifications: List[Dict]):
+        """Reply to one page of mention notifications"""
+        # Oldest first, advancing the cursor as we go so a failure doesn't skip unhandled DMs
+        for notification in reversed(notifications):
+            status = notification['status']
+            dm_id = str(status['id'])
+            if status['visibility'] != 'direct' or self._has_replied_dm(dm_id):
+                self._advance_dm_since_id(notification['id'])
+                continue
+            
+            account = status['account']['acct']
+            # DMs bypass the response cache and use the account's recent exchanges as context
+            response = await self.generate_entertainment_response(
+                status['content'], status, use_cache=False, history=self.dm_context.get(account)
+            )
+            await self._handle_rate_limit()
             try:
-                current_time = time.time()
-                
-                # Handle regular posts
-                if first_run or current_time - self.last_post_time >= self.auto_post_interval:
-                    if self.post_count < self.max_daily_posts:
-                        await self.create_scheduled_post()
-                        self.last_post_time = current_time
-                        self.post_count += 1
-                        print(f"Auto-post complete. Posts today: {self.post_count}/{self.max_daily_posts}")
-                    first_run = False
-                
-                # Handle DMs if enabled
-                if self.dm_settings["enabled"] and self.dm_settings["auto_reply"]:
-                    if current_time % self.dm_settings["reply_interval"] < 60:
-                        await self.handle_direct_messages()
-                
-                # Handle auto-likes
-                if current_time % 300 < 60:  # Check every 5 minutes
-                    await self.auto_like_trending_posts()
-                
-                await asyncio.sleep(60)  # Check every minute
-                
-            except Exception as e:
-                print(f"Error in auto-posting loop: {str(e)}")
-                await asyncio.sleep(300)
+                await self._mapi(
+                    self.client.status_post,
+                    f"@{account} {response}",
+                    in_reply_to_id=status['id'],
+                    visibility='direct'
+                )
+            except (MastodonServerError, MastodonUnauthorizedError):
+                # Transient or config problems: leave the cursor so the DM is retried
+                raise
+            except MastodonAPIError:
+                # Client errors (deleted DM, blocked sender) will never succeed; skip the DM
+                logger.exception("Could not reply to DM %s from @%s, skipping it", dm_id, account)
+                self._mark_dm_replied(dm_id)
+                self._advance_dm_since_id(notification['id'])
+                continue
+            
+            # Keep a short rolling history per account
+            history = self.dm_context.setdefault(account, [])
+            history.append({'message': self._clean_html(status['content']), 'response': response})
+            del history[:-10]
+            self._dm_dirty = True
+            self._mark_dm_replied(dm_id)
+            self._advance_dm_since_id(notification['id'])
+            logger.info("Replied to DM from @%s", account)
+
+    def _advance_dm_since_id(self, notification_id):
+        """Move the DM polling cursor past a handled notification"""
+        self._dm_since_id = notification_id
+        self._dm_dirty = True
+
+    async def auto_like_trending_posts(self):
+        """Favourite popular posts from the newest page of the public timeline"""
+        # since_id returns the newest page; skipping older posts is fine for likes, unlike DMs
+        await self._handle_rate_limit()
+        posts = await self._mapi(self.client.timeline_public, since_id=self._like_since_id, limit=20)
+        if not posts:
+            return
+        self._like_since_id = posts[0]['id']
+        
+        popular = [
+            post for post in posts
+            if not post['favourited']
+            and post['favourites_count'] + post['reblogs_count'] >= self.min_like_engagement
+        ]
+        for post in popular[:self.max_likes_per_run]:
+            await self._handle_rate_limit()
+            await self._mapi(self.client.status_favourite, post['id'])
+            logger.info("Liked post %s", post['id'])
+
+    async def _flush_loop(self):
+        """Periodically persist DM context and the response cache while the bot runs"""
+        while await self._wait(self.flush_interval):
+            self._flush_dm_context()
+            self._flush_response_cache()
+
+    async def schedule_auto_posts(self):
+        """Run scheduled auto-posting, DM handling and auto-likes"""
+        logger.info("Starting scheduled auto-posting service...")
+        await self._run_loops(
+            self._post_loop(initial_delay=0),  # Post right away, as before
+            self._dm_loop(),
+            self._like_loop(),
+            self._daily_reset_loop()
+        )
+
     async def run_forever(self):
         """Main loop for running the bot continuously"""
+        logger.info("Starting Mastodon bot...")
+        await self._run_loops(
+            self._post_loop(initial_delay=self.auto_post_interval),
+            self._dm_loop(),
+            self._like_loop(),
+            self._hashtag_loop(),
+            self._daily_reset_loop()
+        )
+
+    def stop(self):
+        """Stop all running loops"""
+        self.is_running = False
+        if self._stop_event:
+            self._stop_event.set()
+
+    async def _run_loops(self, *loops):
+        """Run independent loops until the bot is stopped"""
+        # Created here rather than in __init__ so it binds to the running loop
+        self._stop_event = asyncio.Event()
+        self._hashtag_sem = asyncio.Semaphore(self.max_concurrent_hashtag_requests)
+        if self.replied_dms is None:
+            self._connect_replied_dms()
         self.is_running = True
-        print("Starting Mastodon bot...")
-        
+        try:
+            await asyncio.gather(self._flush_loop(), *loops)
+        finally:
+            await self.shutdown()
+
+    async def _wait(self, seconds: float) -> bool:
+        """Sleep for an interval, waking early on stop; returns whether still running"""
+        try:
+            await asyncio.wait_for(self._stop_event.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+        return self.is_running
+
+    async def _run_periodic(self, name: str, interval: float, job):
+        """Run a job every interval seconds, backing off for 5 minutes on error"""
         while self.is_running:
             try:
-                current_time = time.time()
-                
-                # Handle regular posts
-                if current_time - self.last_post_time >= self.auto_post_interval:
-                    if self.post_count < self.max_daily_posts:
-                        await self.create_scheduled_post()
-                        self.last_post_time = current_time
-                        self.post_count += 1
-                        print(f"Auto-post complete. Posts today: {self.post_count}/{self.max_daily_posts}")
-                
-                # Monitor hashtags
-                for hashtag in self.hashtags_to_monitor:
-                    await self.monitor_hashtag(hashtag)
-                
-                # Handle DMs
-                await self.handle_direct_messages()
-                
-                # Reset post count at midnight
-                if datetime.now().hour == 0 and datetime.now().minute == 0:
-                    self.post_count = 0
-                
-                await asyncio.sleep(60)  # Check every minute
-                
-            except Exception as e:
-                print(f"Error in main loop: {str(e)}")
-                await asyncio.sleep(300)  # Wait 5 minutes on error
+                await job()
+                delay = interval
+            except Exception:
+                logger.exception("Error in %s loop", name)
+                delay = 300
+            await self._wait(delay)
+
+    async def _post_loop(self, initial_delay: float):
+        if not await self._wait(initial_delay):
+            return
+        await self._run_periodic("auto-posting", self.auto_post_interval, self._auto_post)
+
+    async def _dm_loop(self):
+        if not (self.dm_settings["enabled"] and self.dm_settings["auto_reply"]):
+            return
+        await self._run_periodic("DM", self.dm_settings["reply_interval"], self.handle_direct_messages)
+
+    async def _like_loop(self):
+        await self._run_periodic("auto-like", 300, self.auto_like_trending_posts)
+
+    async def _hashtag_loop(self):
+        await self._run_periodic("hashtag", 60, self._monitor_hashtags)
+
+    async def _daily_reset_loop(self):
+        """Reset the daily post count at midnight"""
+        while self.is_running:
+            now = datetime.now()
+            next_midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+            if not await self._wait((next_midnight - now).total_seconds()):
+                break
+            self.post_count = 0
+
+    async def _auto_post(self):
+        """Create a scheduled post if the daily limit allows"""
+        if self.post_count < self.max_daily_posts and await self.create_scheduled_post():
+            self.post_count += 1
+            logger.info("Auto-post complete. Posts today: %d/%d", self.post_count, self.max_daily_posts)
+
+    async def create_scheduled_post(self) -> bool:
+        """Generate and publish an original post in the current style; returns whether it was posted"""
+        topic = random.choice(self.hashtags_to_monitor)
+        prompt = f"Write a short, original Mastodon post about {topic} in a {self.current_style.value} style."
+        if self.post_config["use_hashtags"]:
+            prompt += " End with 1-2 relevant hashtags."
+        
+        text = await self._generate_content(prompt, generation_config=self._gen_config_text)
+        if text is None:
+            raise RuntimeError("Failed to generate scheduled post")
+        
+        lowered = text.lower()
+        if any(word.lower() in lowered for word in self.post_config["blacklisted_words"]):
+            logger.warning("Skipping scheduled post containing a blacklisted word")
+            return False
+        
+        await self._handle_rate_limit()
+        await self._mapi(self.client.status_post, text[:self.post_config["max_length"]])
+        return True
+
+    async def _monitor_hashtags(self):
+        await asyncio.gather(*(self.monitor_hashtag(h) for h in self.hashtags_to_monitor))
     
     async def monitor_hashtag(self, hashtag: str):
         """Monitor and respond to hashtag posts"""
         try:
-            await self._handle_rate_limit()
-            posts = await self.search_hashtag(hashtag, limit=5)
+            async with self._hashtag_sem:
+                await self._handle_rate_limit()
+                posts = await self.search_hashtag(
+                    hashtag, limit=5, since_id=self._hashtag_since_ids.get(hashtag)
+                )
+            if not posts:
+                return
+            # Only posts newer than the last check get a chance, so each post is considered once
+            self._hashtag_since_ids[hashtag] = posts[0]['id']
             
-            for post in posts:
-                if random.random() < 0.3:  # 30% chance to respond
-                    response = await self.generate_entertainment_response(post['content'])
-                    await self.reply_to_post(post['id'], response)
-                    print(f"Replied to post in #{hashtag}")
-                    await asyncio.sleep(30)  # Wait between responses
+            chosen = [
+                post for post in posts
+                if random.random() < 0.3 and self._claim_post(post['id'])  # 30% chance to respond
+            ]
+            await asyncio.gather(*(self._reply_to_hashtag_post(post, hashtag) for post in chosen))
                     
-        except Exception as e:
-            print(f"Error monitoring hashtag #{hashtag}: {str(e)}")
+        except Exception:
+            logger.exception("Error monitoring hashtag #%s", hashtag)
 
-async def health_check():
+    async def _reply_to_hashtag_post(self, post: Dict, hashtag: str):
+        """Reply to a single hashtag post, sharing the hashtag concurrency limit"""
+        try:
+            # Paced outside the semaphore so waiting replies don't hold up searches
+            await self.reply_limiter.acquire()
+            async with self._hashtag_sem:
+                response = await self.generate_entertainment_response(post['content'])
+                await self.reply_to_post(post['id'], response)
+                logger.info("Replied to post in #%s", hashtag)
+        except Exception:
+            logger.exception("Error replying to post in #%s", hashtag)
+
+    def _claim_post(self, post_id) -> bool:
+        """Record a post as replied to, returning False if it already was"""
+        if post_id in self._replied_posts:
+            return False
+        self._replied_posts[post_id] = True
+        if len(self._replied_posts) > self.replied_posts_size:
+            self._replied_posts.popitem(last=False)
+        return True
+
+_HEALTH_RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nOK"
+
+async def health_check(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
     """Simple health check endpoint"""
-    return web.Response(text="OK", status=200)
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(_HEALTH_RESPONSE)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
 
 async def start_health_check():
-    app = web.Application()
-    app.router.add_get('/health', health_check)
-    runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, 'localhost', 8080)
-    await site.start()
+    return await asyncio.start_server(health_check, 'localhost', 8080)
+
+# Supervised restart settings for the entry point
+_RESTART_DELAY = 30
+_MAX_CONSECUTIVE_FAILURES = 5
+_HEALTHY_RUN_SECONDS = 600  # A run this long resets the failure count
 
 if __name__ == "__main__":
-    # Create and run the bot
-    bot = MastodonBot()
+    # Load environment variables
+    load_dotenv()
     
+    bot = None
+    failures = 0
     try:
-        logging.info("Bot started successfully")
-        asyncio.run(bot.run_forever())
-    except Exception as e:
-        logging.error(f"Fatal error: {str(e)}")
-        # Attempt to restart
-        os.system('docker-compose restart mastodon-bot')
+        while True:
+            started = time.monotonic()
+            try:
+                # Reuse the bot across restarts so the daily post count survives
+                if bot is None:
+                    bot = MastodonBot()
+                logger.info("Bot started successfully")
+                asyncio.run(bot.run_forever())
+                break
+            except Exception:
+                if time.monotonic() - started >= _HEALTHY_RUN_SECONDS:
+                    failures = 0
+                failures += 1
+                if failures >= _MAX_CONSECUTIVE_FAILURES:
+                    logger.exception("Fatal error, giving up after %d consecutive failures", failures)
+                    # Exit non-zero so the platform's ON_FAILURE restart policy takes over
+                    sys.exit(1)
+                logger.exception("Fatal error, restarting in %ds", _RESTART_DELAY)
+            time.sleep(_RESTART_DELAY)
     except KeyboardInterrupt:
-        print("\nBot stopped by user")    
-    except Exception as e:
-        print(f"Fatal error: {str(e)}")
+        logger.info("Bot stopped by user")
@@ -0,0 +1,174 @@
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from collections import OrderedDict
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    # The module opens logs/bot.log on import, so import it from a scratch directory
+    _cwd = os.getcwd()
+    _tmp = tempfile.mkdtemp()
+    os.makedirs(os.path.join(_tmp, 'logs'))
+    os.chdir(_tmp)
+    try:
+        import mastodon_bot
+    finally:
+        os.chdir(_cwd)
+except ImportError as e:
+    mastodon_bot = None
+    _import_error = str(e)
+
+
+class _FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = type('Usage', (), {'prompt_token_count': 0, 'candidates_token_count': 0})()
+
+
+class _FakeModel:
+    def __init__(self):
+        self.calls = 0
+
+    async def generate_content_async(self, content, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        return _FakeResponse(f"reply {self.calls}")
+
+
+@unittest.skipIf(mastodon_bot is None, "bot dependencies not installed")
+class CoalescerTest(unittest.TestCase):
+    def _make_bot(self):
+        bot = mastodon_bot.MastodonBot.__new__(mastodon_bot.MastodonBot)
+        bot.model = _FakeModel()
+        bot.gemini_limiter = mastodon_bot.TokenBucket(60)
+        bot._gen_config_text = None
+        bot.current_style = mastodon_bot.PostStyle.ENTERTAINER
+        bot.response_cache = OrderedDict()
+        bot.response_cache_size = 1024
+        bot.cache_hits = 0
+        bot._response_cache_dirty = False
+        bot._inflight = {}
+        return bot
+
+    def test_concurrent_identical_requests_share_one_call(self):
+        bot = self._make_bot()
+
+        async def run():
+            return await asyncio.gather(
+                bot._generate_text_only("same post", bot.current_style),
+                bot._generate_text_only("same post", bot.current_style)
+            )
+
+        results = asyncio.run(run())
+        self.assertEqual(bot.model.calls, 1)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(bot.cache_hits, 0)
+        self.assertEqual(bot._inflight, {})
+
+    def test_distinct_requests_run_concurrently(self):
+        bot = self._make_bot()
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            await asyncio.gather(*(
+                bot._generate_text_only(f"post {i}", bot.current_style) for i in range(3)
+            ))
+            return loop.time() - start
+
+        elapsed = asyncio.run(run())
+        self.assertEqual(bot.model.calls, 3)
+        self.assertLess(elapsed, 0.15)
+
+
+@unittest.skipIf(mastodon_bot is None, "bot dependencies not installed")
+class HashtagMonitorTest(unittest.TestCase):
+    def _make_bot(self, posts):
+        class FakeBot(mastodon_bot.MastodonBot):
+            async def search_hashtag(self, hashtag, limit=20, since_id=None):
+                self.searches.append(since_id)
+                return posts
+
+            async def generate_entertainment_response(self, post_text, status=None, max_retries=3, **kwargs):
+                return "reply"
+
+            async def reply_to_post(self, post_id, text):
+                self.replies.append(post_id)
+
+        bot = FakeBot.__new__(FakeBot)
+        bot.searches = []
+        bot.replies = []
+        bot.rate_limiter = mastodon_bot.TokenBucket(60)
+        bot.reply_limiter = mastodon_bot.TokenBucket(60)
+        bot._hashtag_since_ids = {}
+        bot._replied_posts = OrderedDict()
+        bot.replied_posts_size = 1024
+        return bot
+
+    def test_each_post_is_replied_to_once(self):
+        bot = self._make_bot([{'id': 2, 'content': "b"}, {'id': 1, 'content': "a"}])
+
+        async def run():
+            bot._hashtag_sem = asyncio.Semaphore(3)
+            await bot.monitor_hashtag("tech")
+            await bot.monitor_hashtag("AI")
+
+        with mock.patch.object(mastodon_bot.random, 'random', return_value=0.0):
+            asyncio.run(run())
+        self.assertEqual(sorted(bot.replies), [1, 2])
+        self.assertEqual(bot._hashtag_since_ids, {'tech': 2, 'AI': 2})
+
+
+@unittest.skipIf(mastodon_bot is None, "bot dependencies not installed")
+class DirectMessageTest(unittest.TestCase):
+    def test_client_error_skips_dm_and_advances_cursor(self):
+        def notification(notification_id, status_id):
+            return {
+                'id': notification_id,
+                'status': {
+                    'id': status_id,
+                    'visibility': 'direct',
+                    'content': "<p>hi</p>",
+                    'account': {'acct': f"user{status_id}"}
+                }
+            }
+
+        class FakeClient:
+            def __init__(self):
+                self.posted = []
+
+            def notifications(self, min_id=None, types=None):
+                return [notification(20, 2), notification(10, 1)] if min_id is None else []
+
+            def status_post(self, text, in_reply_to_id=None, visibility=None):
+                if in_reply_to_id == 1:
+                    raise mastodon_bot.MastodonAPIError("Record not found")
+                self.posted.append(in_reply_to_id)
+
+        class FakeBot(mastodon_bot.MastodonBot):
+            async def generate_entertainment_response(self, post_text, status=None, max_retries=3, **kwargs):
+                return "reply"
+
+        bot = FakeBot.__new__(FakeBot)
+        bot.client = FakeClient()
+        bot.rate_limiter = mastodon_bot.TokenBucket(60)
+        bot.replied_dms = sqlite3.connect(":memory:")
+        bot.replied_dms.execute("CREATE TABLE replied (id TEXT PRIMARY KEY)")
+        bot.dm_context = {}
+        bot._dm_since_id = None
+        bot._dm_dirty = False
+
+        asyncio.run(bot.handle_direct_messages())
+        self.assertEqual(bot.client.posted, [2])
+        self.assertTrue(bot._has_replied_dm("1"))
+        self.assertTrue(bot._has_replied_dm("2"))
+        self.assertEqual(bot._dm_since_id, 20)
+
+
+if __name__ == '__main__':
+    unittest.main()